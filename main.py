@@ -3,13 +3,25 @@
 # @AUTHOR : njmck
 
 import pandas as pd
+import numpy as np
 import json
 import collections
 import re
 from bs4 import BeautifulSoup
 from urllib.request import urlopen
+from urllib.error import HTTPError
+import http.client
 import ssl
 import time
+import os
+import gzip
+import hashlib
+import datetime
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
 
 
 
@@ -34,39 +46,353 @@ def article_url_list(main_url):
 	return url_list
 
 
+def parse_jlpt_vocab(html_doc):
+	'''
+	Accepts the HTML of a single article and returns its vocabulary as a dictionary
+	with the JLPT level as the key and a tuple of (main, kana) lists as the value.
+	Returns None if the page has no article content (e.g. an error or maintenance page).
+	'''
+	jlpt_levels = ['jlpt-n1', 'jlpt-n2', 'jlpt-n3', 'jlpt-n4', 'jlpt-n5']
+	soup = BeautifulSoup(html_doc, 'html.parser')
+	content = soup.find('div', attrs={'class': 'content'})
+	if content is None:
+		return None
+	jlpt_vocab = {}
+	for i_1 in jlpt_levels:
+		jlpt_parent = content.find_all('span', attrs={'class': i_1})
+		jlpt_main = []
+		jlpt_kana = []
+		for i_2 in jlpt_parent:
+			if i_2.find('ruby'):
+				jlpt_main.append(i_2.ruby.find(text=True, recursive=False))
+				jlpt_kana.append(i_2.rt.find(text=True))
+			else:
+				jlpt_main.append(i_2.get_text())
+				jlpt_kana.append(None)
+		jlpt_vocab[i_1] = (jlpt_main, jlpt_kana)
+	return jlpt_vocab
+
+
 def scrape_jlpt_vocab(url_list, sleep_time):
 	'''
 	Accepts the URL list from article_url_list() and compiles the vocabulary into a dictionary
 	separated by URL and JLPT level.
 	'''
-	# Specify JLPT levels and initialise url dictionary to fill with vocabulary sorted by url:
-	jlpt_levels = ['jlpt-n1', 'jlpt-n2', 'jlpt-n3', 'jlpt-n4', 'jlpt-n5']
+	# Initialise url dictionary to fill with vocabulary sorted by url:
 	url_dict = {}
 	# Access each article individually and store words in dictionary:
 	for i_0 in url_list:
 		html_doc = urlopen(i_0, context=ssl._create_unverified_context())
+		jlpt_vocab = parse_jlpt_vocab(html_doc)
+		if jlpt_vocab is None:
+			print('No article content, skipping url: ' + i_0)
+		else:
+			url_dict[i_0] = jlpt_vocab
+			print('Processing url: ' + i_0)
+		# Sleep between each article to save bandwidth or avoid IP address block:
+		time.sleep(sleep_time)
+	return url_dict
+
+
+def html_store_put(html_bytes, store_dir):
+	'''
+	Writes raw article HTML to a gzip-compressed, content-addressed store and returns
+	its SHA-256 hash. Identical pages are only stored once.
+	'''
+	html_hash = hashlib.sha256(html_bytes).hexdigest()
+	# Fan out into sub-directories so no single directory holds tens of thousands of files:
+	sub_dir = os.path.join(store_dir, html_hash[:2])
+	filename = os.path.join(sub_dir, html_hash + '.html.gz')
+	if not os.path.exists(filename):
+		os.makedirs(sub_dir, exist_ok=True)
+		tmp_filename = filename + '.tmp'
+		with gzip.open(tmp_filename, 'wb') as gzfile:
+			gzfile.write(html_bytes)
+		os.replace(tmp_filename, filename)
+	return html_hash
+
+
+def html_store_get(html_hash, store_dir):
+	'''
+	Reads raw article HTML back from the content-addressed store by its hash.
+	'''
+	filename = os.path.join(store_dir, html_hash[:2], html_hash + '.html.gz')
+	with gzip.open(filename, 'rb') as gzfile:
+		html_bytes = gzfile.read()
+	return html_bytes
+
+
+def checkpoint_load(checkpoint_filename):
+	'''
+	Loads the progress of an archive crawl from disk, or returns an empty checkpoint
+	if the crawl has not been started yet.
+	'''
+	if os.path.exists(checkpoint_filename):
+		with open(checkpoint_filename, 'r') as jsonfile:
+			checkpoint = json.load(jsonfile)
+	else:
+		checkpoint = {'dates_done': [], 'url_dates': {}, 'html_hashes': {}}
+	# Checkpoints written before failures were recorded have no 'failed' maps:
+	checkpoint.setdefault('failed', {})
+	checkpoint.setdefault('failed_dates', {})
+	return checkpoint
+
+
+def checkpoint_save(checkpoint, checkpoint_filename):
+	'''
+	Saves the progress of an archive crawl to disk. The file is replaced atomically so an
+	interrupted write cannot corrupt an existing checkpoint.
+	'''
+	tmp_filename = checkpoint_filename + '.tmp'
+	with open(tmp_filename, 'w') as jsonfile:
+		json.dump(checkpoint, jsonfile)
+	os.replace(tmp_filename, checkpoint_filename)
+
+
+def archive_url_list(archive_url, date, sleep_time, max_pages=100, timeout=30):
+	'''
+	Accepts an archive listing URL template and a date, and returns a list of URLs of all
+	articles listed for that date. The template is filled with str.format() using the
+	'date' and 'page' keywords, e.g. "...?date={date:%Y-%m-%d}&page={page}".
+	Pages are requested in turn until a page lists no new articles, or a page after the
+	first returns 404. Raises an exception if max_pages is reached, rather than silently
+	dropping the remaining pages.
+	'''
+	url_list = []
+	for page in range(1, max_pages + 1):
+		url = archive_url.format(date=date, page=page)
+		try:
+			html_doc = urlopen(url, context=ssl._create_unverified_context(), timeout=timeout)
+		except HTTPError as error:
+			# Some listings return 404 rather than an empty page past the last page:
+			if error.code == 404 and page > 1:
+				break
+			raise
 		soup = BeautifulSoup(html_doc, 'html.parser')
-		content = soup.find('div', attrs={'class': 'content'})
-		jlpt_vocab = {}
-		for i_1 in jlpt_levels:
-			jlpt_parent = content.find_all('span', attrs={'class': i_1})
-			jlpt_main = []
-			jlpt_kana = []
-			for i_2 in jlpt_parent:
-				if i_2.find('ruby'):
-					jlpt_main.append(i_2.ruby.find(text=True, recursive=False))
-					jlpt_kana.append(i_2.rt.find(text=True))
-				else:
-					jlpt_main.append(i_2.get_text())
-					jlpt_kana.append(None)
-			jlpt_vocab[i_1] = (jlpt_main, jlpt_kana)
+		content1 = soup.find_all('a', attrs={'class': 'row no-margin item-recent '})
+		content2 = soup.find_all('a', attrs={'class': 'row no-margin item-recent news-more'})
+		new_urls = [i_0['href'] for i_0 in content1 + content2 if i_0['href'] not in url_list]
+		if new_urls == []:
+			break
+		url_list += new_urls
+		time.sleep(sleep_time)
+	else:
+		raise Exception('Listing for ' + str(date) + ' has more than ' + str(max_pages) + ' pages. Increase max_pages.')
+	return url_list
+
+
+def archive_crawl(archive_url, start_date, end_date, checkpoint_filename, store_dir, sleep_time, checkpoint_every=50, max_retries=3, max_pages=100, timeout=30):
+	'''
+	Crawls the historical article listings between start_date and end_date (inclusive,
+	in the same 'YYYY.MM.DD' format as yesterday_date) and saves the raw HTML of every
+	article to the content-addressed store in store_dir.
+	Progress is checkpointed to disk so an interrupted crawl resumes where it stopped.
+	Dates from today onwards are listed again on the next run, as their listings may still grow.
+	Dates whose listing fails to download are recorded in checkpoint['failed_dates'], and
+	articles that fail to download in checkpoint['failed'], with their number of attempts.
+	Either is skipped once it has failed max_retries times.
+	Returns the checkpoint, which maps each URL to its date and HTML hash.
+	'''
+	checkpoint = checkpoint_load(checkpoint_filename)
+	first_date = datetime.datetime.strptime(start_date, '%Y.%m.%d').date()
+	last_date = datetime.datetime.strptime(end_date, '%Y.%m.%d').date()
+	today = datetime.date.today()
+	try:
+		# Collect the article URLs for each date not already listed:
+		date = first_date
+		while date <= last_date:
+			date_str = date.strftime('%Y.%m.%d')
+			if date_str in checkpoint['dates_done'] or checkpoint['failed_dates'].get(date_str, 0) >= max_retries:
+				date += datetime.timedelta(days=1)
+				continue
+			try:
+				for i_0 in archive_url_list(archive_url, date, sleep_time, max_pages, timeout):
+					checkpoint['url_dates'].setdefault(i_0, date_str)
+				checkpoint['failed_dates'].pop(date_str, None)
+				# Only past dates have a final listing:
+				if date < today:
+					checkpoint['dates_done'].append(date_str)
+				print('Listed date: ' + date_str)
+			except (OSError, http.client.HTTPException) as error:
+				checkpoint['failed_dates'][date_str] = checkpoint['failed_dates'].get(date_str, 0) + 1
+				print('Failed date: ' + date_str + ' (' + str(error) + ')')
+			checkpoint_save(checkpoint, checkpoint_filename)
+			date += datetime.timedelta(days=1)
+		# Fetch each article not already in the store:
+		fetched = 0
+		for i_0 in checkpoint['url_dates']:
+			if i_0 in checkpoint['html_hashes'] or checkpoint['failed'].get(i_0, 0) >= max_retries:
+				continue
+			try:
+				html_doc = urlopen(i_0, context=ssl._create_unverified_context(), timeout=timeout)
+				html_bytes = html_doc.read()
+			# URLError, HTTPError and socket timeouts are all OSError subclasses:
+			except (OSError, http.client.HTTPException) as error:
+				checkpoint['failed'][i_0] = checkpoint['failed'].get(i_0, 0) + 1
+				print('Failed url: ' + i_0 + ' (' + str(error) + ')')
+			else:
+				checkpoint['html_hashes'][i_0] = html_store_put(html_bytes, store_dir)
+				checkpoint['failed'].pop(i_0, None)
+				print('Fetched url: ' + i_0)
+			fetched += 1
+			if fetched % checkpoint_every == 0:
+				checkpoint_save(checkpoint, checkpoint_filename)
+			# Sleep between each article to save bandwidth or avoid IP address block:
+			time.sleep(sleep_time)
+	finally:
+		checkpoint_save(checkpoint, checkpoint_filename)
+	return checkpoint
+
+
+def scrape_jlpt_vocab_offline(html_hashes, store_dir):
+	'''
+	Accepts a dictionary of URL to HTML hash from archive_crawl() and compiles the vocabulary
+	into the same dictionary format as scrape_jlpt_vocab(), without re-fetching any articles.
+	'''
+	url_dict = {}
+	for i_0 in html_hashes:
+		html_doc = html_store_get(html_hashes[i_0], store_dir)
+		jlpt_vocab = parse_jlpt_vocab(html_doc)
+		if jlpt_vocab is None:
+			print('No article content, skipping url: ' + i_0)
+			continue
 		url_dict[i_0] = jlpt_vocab
 		print('Processing url: ' + i_0)
-		# Sleep between each article to save bandwidth or avoid IP address block:
-		time.sleep(sleep_time)
 	return url_dict
 
 
+def corpus_store(url_dict, url_dates, corpus_dir):
+	'''
+	Persists the vocabulary in url_dict to a compressed, columnar corpus file in corpus_dir.
+	url_dates maps each URL to its article date in 'YYYY.MM.DD' format.
+	Uses Parquet if pyarrow is installed, otherwise a compressed numpy file where strings
+	are stored once and each article's words are integer ids into that string table.
+	Each call writes a new file named by its run time, so earlier runs are never overwritten.
+	Returns the filename written, or None if url_dict is empty.
+	'''
+	jlpt_levels = ['jlpt-n1', 'jlpt-n2', 'jlpt-n3', 'jlpt-n4', 'jlpt-n5']
+	if url_dict == {}:
+		print('No articles to store in corpus.')
+		return None
+	os.makedirs(corpus_dir, exist_ok=True)
+	dates = sorted(url_dates[i_0] for i_0 in url_dict)
+	# Lead with the run time so that sorted filenames are in the order they were written:
+	run_time = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+	basename = os.path.join(corpus_dir, run_time + '_' + dates[0] + '_' + dates[-1])
+	if pa is not None:
+		columns = {'url': [], 'date': [], 'main': [], 'kana': [], 'level': []}
+		for i_0 in url_dict:
+			for i_1 in jlpt_levels:
+				for main, kana in zip(*url_dict[i_0][i_1]):
+					columns['url'].append(i_0)
+					columns['date'].append(url_dates[i_0])
+					columns['main'].append(None if main is None else str(main))
+					columns['kana'].append(None if kana is None else str(kana))
+					columns['level'].append(i_1)
+		filename = basename + '.parquet'
+		pq.write_table(pa.table(columns), filename, use_dictionary=True, compression='zstd')
+		return filename
+	# Dictionary-encode every string, with -1 standing in for a missing value:
+	string_ids = {}
+	main_ids = []
+	kana_ids = []
+	level_ids = []
+	offsets = [0]
+	for i_0 in url_dict:
+		for level_id, i_1 in enumerate(jlpt_levels):
+			for main, kana in zip(*url_dict[i_0][i_1]):
+				main_ids.append(-1 if main is None else string_ids.setdefault(str(main), len(string_ids)))
+				kana_ids.append(-1 if kana is None else string_ids.setdefault(str(kana), len(string_ids)))
+				level_ids.append(level_id)
+		offsets.append(len(main_ids))
+	filename = basename + '.npz'
+	np.savez_compressed(
+						filename,
+						strings=np.array(list(string_ids), dtype=str),
+						urls=np.array(list(url_dict), dtype=str),
+						dates=np.array([url_dates[i_0] for i_0 in url_dict], dtype=str),
+						offsets=np.array(offsets, dtype=np.int64),
+						main_ids=np.array(main_ids, dtype=np.int32),
+						kana_ids=np.array(kana_ids, dtype=np.int32),
+						level_ids=np.array(level_ids, dtype=np.int8)
+						)
+	return filename
+
+
+def corpus_load(corpus_dir):
+	'''
+	Loads every corpus file in corpus_dir into a single dataframe with one row per word
+	and the columns url, date, main, kana and level.
+	An article stored by several runs is only loaded from the most recent file.
+	'''
+	jlpt_levels = ['jlpt-n1', 'jlpt-n2', 'jlpt-n3', 'jlpt-n4', 'jlpt-n5']
+	col_names = ['url', 'date', 'main', 'kana', 'level']
+	filenames = sorted(os.listdir(corpus_dir)) if os.path.isdir(corpus_dir) else []
+	df_list = []
+	seen_urls = set()
+	# Read the newest files first so that repeated articles are taken from the latest run:
+	for i_0 in reversed(filenames):
+		filename = os.path.join(corpus_dir, i_0)
+		if i_0.endswith('.parquet'):
+			partition_df = pd.read_parquet(filename)
+		elif i_0.endswith('.npz'):
+			with np.load(filename) as npzfile:
+				strings = npzfile['strings']
+				article_lens = np.diff(npzfile['offsets'])
+				# Repeat per-article codes rather than strings to keep url and date dictionary-encoded:
+				urls = npzfile['urls']
+				date_cats, date_codes = np.unique(npzfile['dates'], return_inverse=True)
+				partition_df = pd.DataFrame({
+											'url': pd.Categorical.from_codes(np.repeat(np.arange(len(urls)), article_lens), urls),
+											'date': pd.Categorical.from_codes(np.repeat(date_codes, article_lens), date_cats),
+											'main': pd.Categorical.from_codes(npzfile['main_ids'], strings),
+											'kana': pd.Categorical.from_codes(npzfile['kana_ids'], strings),
+											'level': pd.Categorical.from_codes(npzfile['level_ids'], jlpt_levels)
+											})
+		else:
+			continue
+		partition_urls = set(partition_df['url'])
+		df_list.append(partition_df[~partition_df['url'].isin(seen_urls)])
+		seen_urls |= partition_urls
+	if df_list == []:
+		corpus_df = pd.DataFrame(columns=col_names)
+	else:
+		corpus_df = pd.concat(reversed(df_list), ignore_index=True)
+	# Keep the repeated strings dictionary-encoded in memory too:
+	for i_0 in corpus_df.columns:
+		corpus_df[i_0] = corpus_df[i_0].astype('category')
+	return corpus_df
+
+
+def corpus_top_words(corpus_df, level, start_date, end_date, n):
+	'''
+	Returns the n most frequent words of a JLPT level (e.g. 'jlpt-n1') between start_date
+	and end_date (inclusive, 'YYYY.MM.DD' format) with their counts.
+	'''
+	# Compare dates on the (few) categories rather than on every row:
+	date_cats = corpus_df['date'].cat.categories
+	in_range = corpus_df['date'].isin(date_cats[(date_cats >= start_date) & (date_cats <= end_date)])
+	mask = (corpus_df['level'] == level) & in_range
+	counts = corpus_df.loc[mask, 'main'].value_counts()
+	return counts[counts > 0].head(n)
+
+
+def corpus_new_words(corpus_df, since_date, level=None):
+	'''
+	Returns the words first seen on or after since_date ('YYYY.MM.DD' format) with their
+	counts, optionally limited to one JLPT level.
+	'''
+	# Compare dates on the (few) categories rather than on every row:
+	date_cats = corpus_df['date'].cat.categories
+	mask = corpus_df['date'].isin(date_cats[date_cats >= since_date])
+	before_words = set(corpus_df.loc[~mask, 'main'].dropna())
+	if level is not None:
+		mask &= corpus_df['level'] == level
+	since_main = corpus_df.loc[mask, 'main']
+	counts = since_main[~since_main.isin(before_words)].value_counts()
+	return counts[counts > 0]
+
+
 def wwwjdic_import(json_filename):
 	'''
 	Imports the WWJDIC Japanese-English json file as a dictionary.
@@ -669,6 +995,20 @@ yesterday_date = '2021.09.19'
 url_list = article_url_list("http://easyjapanese.net/news/normal/all?hl=en-US")
 url_dict = scrape_jlpt_vocab(url_list, 1) # Time delay in seconds to access each article.
 
+# Alternatively, crawl the historical archive for a date range and parse the stored HTML offline:
+# checkpoint = archive_crawl("http://easyjapanese.net/news/normal/all?date={date:%Y-%m-%d}&page={page}&hl=en-US",
+# 						   '2021.08.01', '2021.08.31', "archive_checkpoint.json", "html_store", 1)
+# url_dict = scrape_jlpt_vocab_offline(checkpoint['html_hashes'], "html_store")
+
+# Persist the vocabulary of each article to the corpus for later analytics
+# (pass checkpoint['url_dates'] instead when parsing an archive crawl):
+# Landing-page articles are from yesterday; don't reuse the hand-edited yesterday_date here,
+# as a stale date would be written permanently into the corpus:
+article_date = (datetime.date.today() - datetime.timedelta(days=1)).strftime('%Y.%m.%d')
+corpus_store(url_dict, {i_0: article_date for i_0 in url_dict}, "corpus")
+# corpus_df = corpus_load("corpus")
+# print(corpus_top_words(corpus_df, 'jlpt-n1', '2021.09.01', '2021.09.30', 20))
+
 # Use the WWWJDIC dictionary to generate dataframes and lists of definitions:
 wwwjdic_dict = wwwjdic_import("wwwjdic.json")
 jp_list = wwwjdic_jp(wwwjdic_dict)